@@ -1,22 +1,30 @@
+import functools
 import os
 import shutil
+import stat
 import uuid
 import threading
 import time
-import base64
 import urllib.parse
+from collections import OrderedDict
 from pathlib import Path
-from typing import List, Optional
+from typing import List, Optional, Tuple
 import logging
 
+import aiofiles
+import orjson
+import pybase64
 from fastapi import APIRouter, File, UploadFile, HTTPException, BackgroundTasks, Form, Request
-from fastapi.responses import FileResponse, JSONResponse, RedirectResponse, Response
+from fastapi.responses import FileResponse, RedirectResponse, Response
 from pydantic import BaseModel
-from config import KK_HOST_PUBLIC, MAX_UPLOAD_SIZE_BYTES
+from config import KK_HOST_PUBLIC, MAX_UPLOAD_SIZE_BYTES, KK_TEMP_TTL_SECONDS
+from api.limits import UploadLimitRoute
+from api.responses import ORJSONResponse
+from utils.files import cleanup_temp_files
 
 logger = logging.getLogger(__name__)
 
-router = APIRouter(prefix="/kkfileview", tags=["kkfileview"])
+router = APIRouter(prefix="/kkfileview", tags=["kkfileview"], route_class=UploadLimitRoute)
 
 # Config (read from config.py which loads env/.env/env.example)
 
@@ -27,14 +35,11 @@ UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
 
-def cleanup_temp_files(file_paths: List[str]):
-    for file_path in file_paths:
-        try:
-            if os.path.exists(file_path):
-                os.remove(file_path)
-                logger.info(f"已清理临时文件: {file_path}")
-        except Exception as e:
-            logger.error(f"清理临时文件失败: {file_path}, 错误: {e}")
+# 上传文件索引：file_id -> (磁盘路径, 原始文件名)，避免每次访问都扫描 UPLOAD_DIR
+# 清理线程默认关闭，索引按插入顺序限长；被挤出的条目由 temp_file 按 file_id + 扩展名回退定位
+_MAX_UPLOAD_INDEX = 10000
+_upload_lock = threading.Lock()
+_uploads: "OrderedDict[str, Tuple[Path, str]]" = OrderedDict()
 
 
 def _schedule_cleanup(paths: List[str], delay: int):
@@ -46,6 +51,110 @@ def _schedule_cleanup(paths: List[str], delay: int):
         logger.error(f"无法调度清理任务: {e}")
 
 
+# 标准 base64 输出中只有 + / = 需要 urlencode，等价于 urllib.parse.quote(b64, safe='')
+_B64_KK_TABLE = str.maketrans({"+": "%2B", "/": "%2F", "=": "%3D"})
+_KK_PREVIEW_PATH = b"/onlinePreview?url="
+
+
+# 过期文件清理：每 5 分钟扫描一次，每删除 100 个文件暂停 50ms，避免集中的 unlink 风暴
+_SWEEP_INTERVAL_SECONDS = 300
+_SWEEP_BATCH_SIZE = 100
+_SWEEP_BATCH_PAUSE_SECONDS = 0.05
+
+
+def _sweep_expired_uploads(ttl: int) -> int:
+    """
+    删除 UPLOAD_DIR 下超过 ttl 秒未访问的文件，并移除清理后变空的子目录。
+    返回删除的文件数。
+    """
+    now = time.time()
+    removed = 0
+    subdirs: List[str] = []
+    pending = [str(UPLOAD_DIR)]
+    while pending:
+        current = pending.pop()
+        try:
+            with os.scandir(current) as it:
+                entries = list(it)
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+                pending.append(entry.path)
+                continue
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            # noatime/relatime 挂载下 atime 可能不更新，取 atime 与 mtime 中较新者
+            if now - max(st.st_atime, st.st_mtime) < ttl:
+                continue
+            with _upload_lock:
+                _uploads.pop(os.path.splitext(entry.name)[0], None)
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                logger.error(f"清理过期文件失败: {entry.path}, 错误: {e}")
+                continue
+            removed += 1
+            if removed % _SWEEP_BATCH_SIZE == 0:
+                time.sleep(_SWEEP_BATCH_PAUSE_SECONDS)
+    # 自底向上删除已空的子目录（UPLOAD_DIR 本身保留）
+    for d in reversed(subdirs):
+        try:
+            os.rmdir(d)
+        except OSError:
+            pass
+    return removed
+
+
+def _sweeper_loop():
+    while True:
+        time.sleep(_SWEEP_INTERVAL_SECONDS)
+        try:
+            removed = _sweep_expired_uploads(KK_TEMP_TTL_SECONDS)
+            if removed:
+                logger.info(f"已清理过期上传文件 {removed} 个")
+        except Exception as e:
+            logger.error(f"过期文件清理失败: {e}")
+
+
+if KK_TEMP_TTL_SECONDS > 0:
+    threading.Thread(target=_sweeper_loop, daemon=True, name="kkfileview-sweeper").start()
+
+
+def _kk_url_param(target_url: str) -> str:
+    # base64 + urlencode for kk (kk 3.x)
+    return pybase64.b64encode(target_url.encode()).decode().translate(_B64_KK_TABLE)
+
+
+def _encode_preview_url(kk_base_url: str, target_url: str) -> str:
+    return f"{kk_base_url.rstrip('/')}/onlinePreview?url={_kk_url_param(target_url)}"
+
+
+# 只缓存入参较短的响应体，避免超长 URL 把缓存撑大
+_PREVIEW_CACHE_MAX_INPUT = 2048
+
+
+def _build_preview_body(kk_base_url: str, target_url: str) -> bytes:
+    """
+    /preview/url 的响应只取决于入参：直接拼出 JSON 响应体字节。
+    kk_base_url 由调用方传入，经 orjson 转义后写入；编码后的 url 参数只含 JSON 安全字符。
+    """
+    buf = bytearray(b'{"preview_url":')
+    buf += orjson.dumps(kk_base_url.rstrip('/'))[:-1]
+    buf += _KK_PREVIEW_PATH
+    buf += _kk_url_param(target_url).encode()
+    buf += b'"}'
+    return bytes(buf)
+
+
+_cached_preview_body = functools.lru_cache(maxsize=4096)(_build_preview_body)
+
+
 class PreviewURLBody(BaseModel):
     kk_base_url: str
     target_url: str
@@ -79,10 +188,11 @@ async def preview_url(body: PreviewURLBody):
             raise HTTPException(status_code=400, detail="target_url 必须以文件名和扩展名结尾，或在 query 中包含 fullfilename=xxx.ext")
     else:
         original_url = target_url
-    b64 = base64.b64encode(original_url.encode()).decode()
-    encoded = urllib.parse.quote(b64, safe='')
-    preview_url = f"{kk_base_url.rstrip('/')}/onlinePreview?url={encoded}"
-    return JSONResponse({"preview_url": preview_url})
+    if len(kk_base_url) + len(original_url) < _PREVIEW_CACHE_MAX_INPUT:
+        content = _cached_preview_body(kk_base_url, original_url)
+    else:
+        content = _build_preview_body(kk_base_url, original_url)
+    return Response(content=content, media_type="application/json")
 
 
 @router.post("/preview/file")
@@ -106,19 +216,25 @@ async def preview_file(
 
     try:
         total = 0
-        with open(dest_path, "wb") as out_f:
+        async with aiofiles.open(dest_path, "wb") as out_f:
             while True:
                 chunk = await file.read(2 * 1024 * 1024)
                 if not chunk:
                     break
                 total += len(chunk)
                 if total > MAX_UPLOAD_SIZE_BYTES:
-                    out_f.close()
-                    os.remove(dest_path)
-                    raise HTTPException(status_code=413, detail=f"文件大小超过限制: {MAX_UPLOAD_SIZE_BYTES} bytes")
-                out_f.write(chunk)
+                    break
+                await out_f.write(chunk)
+        if total > MAX_UPLOAD_SIZE_BYTES:
+            dest_path.unlink(missing_ok=True)
+            raise HTTPException(status_code=413, detail=f"文件大小超过限制: {MAX_UPLOAD_SIZE_BYTES} bytes")
 
         logger.info(f"已保存上传文件: {dest_path} (size={total})")
+        original_name = file.filename or safe_name
+        with _upload_lock:
+            _uploads[file_id] = (dest_path, original_name)
+            while len(_uploads) > _MAX_UPLOAD_INDEX:
+                _uploads.popitem(last=False)
 
         # build temp URL (accessible by kk). Use KK_HOST_PUBLIC as host for constructing URL (no sig)
         host_cfg = KK_HOST_PUBLIC.rstrip('/')
@@ -127,39 +243,58 @@ async def preview_file(
         else:
             base_url = f"http://{host_cfg}"
         # Use uploaded original filename so kkFileView can detect type
-        original_name = file.filename or safe_name
         quoted_name = urllib.parse.quote(original_name)
         temp_url = f"{base_url}/kkfileview/temp/{file_id}?fullfilename={quoted_name}"
 
-        # base64 + urlencode for kk (kk 3.x)
-        b64 = base64.b64encode(temp_url.encode()).decode()
-        encoded = urllib.parse.quote(b64, safe='')
-        preview_url = f"{kk_base_url.rstrip('/')}/onlinePreview?url={encoded}"
+        # temp_url 每次上传都不同，不走缓存
+        preview_url = _encode_preview_url(kk_base_url, temp_url)
 
-        # keep file permanently (no scheduled cleanup)
-        return JSONResponse({"preview_url": preview_url, "temp_url": temp_url})
+        # keep file permanently unless KK_TEMP_TTL_SECONDS enables the background sweeper
+        return ORJSONResponse({"preview_url": preview_url, "temp_url": temp_url})
 
     except HTTPException:
         raise
     except Exception as e:
         logger.error(f"上传处理失败: {e}")
-        if dest_path.exists():
-            os.remove(dest_path)
+        dest_path.unlink(missing_ok=True)
         raise HTTPException(status_code=500, detail=f"上传失败: {e}")
 
 
 @router.get("/temp/{file_id}")
-async def temp_file(file_id: str, fullfilename: Optional[str] = None):
+async def temp_file(request: Request, file_id: str, fullfilename: Optional[str] = None):
     """
     临时文件访问：直接返回文件流（无签名/过期校验，按用户要求简单暴露）。
     支持 `fullfilename` 查询参数以让客户端（如 kkFileView）识别文件类型。
+    带 ETag / Last-Modified，kkFileView 重复拉取时可直接返回 304。
     """
-    candidates = list(UPLOAD_DIR.glob(f"{file_id}*"))
-    if not candidates:
+    with _upload_lock:
+        entry = _uploads.get(file_id)
+    if entry:
+        path, original_name = entry
+    else:
+        # 内存索引中没有（如服务重启后）：按 file_id + fullfilename 扩展名直接定位，不扫描目录
+        try:
+            uuid.UUID(file_id)
+        except ValueError:
+            raise HTTPException(status_code=404, detail="文件不存在")
+        file_ext = Path(fullfilename).suffix if fullfilename else ""
+        path = UPLOAD_DIR / f"{file_id}{file_ext}"
+        original_name = None
+    try:
+        st = path.stat()
+    except OSError:
+        raise HTTPException(status_code=404, detail="文件不存在")
+    if not stat.S_ISREG(st.st_mode):
         raise HTTPException(status_code=404, detail="文件不存在")
-    path = candidates[0]
-    resp_filename = fullfilename or path.name
-    return FileResponse(path=str(path), filename=resp_filename)
+
+    etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+    cache_headers = {"ETag": etag, "Cache-Control": "public, max-age=3600"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=cache_headers)
+
+    resp_filename = fullfilename or original_name or path.name
+    return FileResponse(path=str(path), filename=resp_filename, headers=cache_headers, stat_result=st)
 # Note: auth endpoint and signature logic removed per user instruction.
 
 
@@ -1,14 +1,24 @@
+import asyncio
 import os
-import shutil
 import uuid
 import threading
+import time
+import urllib.parse
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import Dict, Any, Optional
 import logging
+from collections import OrderedDict
 
-import requests
-from fastapi import APIRouter, File, UploadFile, HTTPException, BackgroundTasks, Form
-from fastapi.responses import FileResponse, JSONResponse
+import aiofiles
+import httpx
+from fastapi import APIRouter, File, UploadFile, HTTPException, BackgroundTasks, Form, Request
+from fastapi.responses import FileResponse, StreamingResponse
+from starlette.background import BackgroundTask
+
+from api.responses import ORJSONResponse
+from config import LIBRE_WORKER_THREADS
+from utils.files import advise_sequential, cleanup_temp_files, drop_page_cache
+from utils.tasks import EvictedTasks, start_task_sweeper, trim_tasks
 
 logger = logging.getLogger(__name__)
 
@@ -20,7 +30,7 @@ OUTPUT_DIR = Path("temp/libreoffice/outputs")
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
-SUPPORTED_FORMATS = [
+SUPPORTED_FORMATS = frozenset({
     '.doc', '.docx',
     '.odt',
     '.rtf',
@@ -32,41 +42,72 @@ SUPPORTED_FORMATS = [
     '.csv',
     '.ppt', '.pptx',
     '.odp',
-]
-
-
-def cleanup_temp_files(file_paths: List[str]):
-    """清理临时文件"""
-    for file_path in file_paths:
-        try:
-            if os.path.exists(file_path):
-                os.remove(file_path)
-                logger.info(f"已清理临时文件: {file_path}")
-        except Exception as e:
-            logger.error(f"清理临时文件失败: {file_path}, 错误: {e}")
+})
 
 
 # 简单的内存任务状态存储（单进程场景）
 _task_lock = threading.Lock()
-_task_status: Dict[str, Dict[str, Any]] = {}
+_task_status: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+# 任务表上限；已结束但一直未被取走的任务保留时长，超时后连同临时文件一起清理
+_MAX_TASKS = 10000
+_TASK_RETENTION_SECONDS = 30 * 60
+
+# 限制同时进行的异步转换数量；首次使用时在事件循环中创建
+_convert_slots: Optional[asyncio.Semaphore] = None
+
+
+def _get_convert_slots() -> asyncio.Semaphore:
+    global _convert_slots
+    if _convert_slots is None:
+        _convert_slots = asyncio.Semaphore(LIBRE_WORKER_THREADS)
+    return _convert_slots
+
+
+def _cleanup_evicted_tasks(evicted: EvictedTasks):
+    cleanup_temp_files([p for task_id, task in evicted for p in (task['input_path'], str(OUTPUT_DIR / f"{task_id}.pdf"))])
+
 
+start_task_sweeper("libreoffice-task-sweeper", _task_status, _task_lock, _TASK_RETENTION_SECONDS, _cleanup_evicted_tasks)
 
-def _post_to_gotenberg_and_save(gotenberg_url: str, input_path: Path, output_path: Path, convert_options: Dict[str, str], timeout: int = 300):
+
+async def _save_upload(file: UploadFile, dest: Path):
+    """分块写入上传文件，避免阻塞事件循环"""
+    async with aiofiles.open(dest, "wb") as buffer:
+        while chunk := await file.read(2 * 1024 * 1024):
+            await buffer.write(chunk)
+
+
+def _content_disposition(filename: str) -> str:
+    """构造 Content-Disposition 头，非 ASCII 文件名按 RFC 5987 编码"""
+    quoted = urllib.parse.quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+
+async def _post_to_gotenberg_and_save(client: httpx.AsyncClient, gotenberg_url: str, input_path: Path, output_path: Path, convert_options: Dict[str, str], timeout: int = 300):
     with open(input_path, 'rb') as f:
+        advise_sequential(f.fileno())
         files = {'file': f}
-        response = requests.post(gotenberg_url, files=files, data=convert_options, timeout=timeout)
-
-    if response.status_code == 200:
-        with open(output_path, 'wb') as out_f:
-            out_f.write(response.content)
-        return True, None
-    else:
-        return False, f"HTTP {response.status_code}: {response.text}"
+        async with client.stream("POST", gotenberg_url, files=files, data=convert_options, timeout=timeout) as response:
+            # 上传已完成，输入文件不会再被读取
+            await asyncio.to_thread(drop_page_cache, f.fileno())
+            if response.status_code != 200:
+                await response.aread()
+                return False, f"HTTP {response.status_code}: {response.text}"
+            # 按 1MB 分块落盘，峰值内存与 PDF 大小无关
+            async with aiofiles.open(output_path, 'wb') as out_f:
+                async for chunk in response.aiter_bytes(1024 * 1024):
+                    await out_f.write(chunk)
+                # 结果 PDF 只会在客户端取结果时顺序读取一次，不必常驻页缓存
+                await out_f.flush()
+                await asyncio.to_thread(drop_page_cache, out_f.fileno())
+    return True, None
 
 
 @router.post("/converter_to_pdf")
 async def convert_document(
-    background_tasks: BackgroundTasks,
+    request: Request,
     base_url: str = Form(..., description="Gotenberg服务地址"),
     file: UploadFile = File(..., description="要转换的文档文件"),
     marginTop: str = Form(default="1"),
@@ -79,66 +120,72 @@ async def convert_document(
     preferCSSPageSize: str = Form(default="true")
 ):
     """
-    同步转换接口：上传文件并直接返回 PDF 文件，转换完成后立即调度清理临时文件。
+    同步转换接口：上传内容直接流式转发给 Gotenberg，PDF 结果再流式返回，全程不落盘。
     """
     if not file.filename:
         raise HTTPException(status_code=400, detail="未提供文件名")
 
-    file_ext = Path(file.filename).suffix.lower()
+    upload_name = Path(file.filename)
+    file_ext = upload_name.suffix.lower()
+    stem = upload_name.stem
     if file_ext not in SUPPORTED_FORMATS:
         raise HTTPException(status_code=400, detail=f"不支持的文件格式: {file_ext}")
 
-    file_id = str(uuid.uuid4())
-    input_path = UPLOAD_DIR / f"{file_id}_{file.filename}"
-    output_path = OUTPUT_DIR / f"{file_id}.pdf"
-
-    temp_files = [str(input_path), str(output_path)]
-
+    convert_options = {
+        'marginTop': marginTop,
+        'marginBottom': marginBottom,
+        'marginLeft': marginLeft,
+        'marginRight': marginRight,
+        'landscape': landscape,
+        'printBackground': printBackground,
+        'preferCSSPageSize': preferCSSPageSize
+    }
+    if pageRanges.strip():
+        convert_options['pageRanges'] = pageRanges
+
+    gotenberg_url = f"{base_url.rstrip('/')}/forms/libreoffice/convert"
+    content_type = file.content_type or 'application/octet-stream'
+
+    client: httpx.AsyncClient = request.app.state.http
     try:
-        # 保存上传文件
-        with open(input_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-
-        convert_options = {
-            'marginTop': marginTop,
-            'marginBottom': marginBottom,
-            'marginLeft': marginLeft,
-            'marginRight': marginRight,
-            'landscape': landscape,
-            'printBackground': printBackground,
-            'preferCSSPageSize': preferCSSPageSize
-        }
-        if pageRanges.strip():
-            convert_options['pageRanges'] = pageRanges
-
-        gotenberg_url = f"{base_url.rstrip('/')}/forms/libreoffice/convert"
-
-        success, err = _post_to_gotenberg_and_save(gotenberg_url, input_path, output_path, convert_options)
-        if success:
-            # 清理临时文件（在响应完成后执行）
-            background_tasks.add_task(cleanup_temp_files, temp_files)
-            return FileResponse(
-                path=str(output_path),
-                media_type='application/pdf',
-                filename=f"converted_{file.filename.rsplit('.', 1)[0]}.pdf"
-            )
-        else:
-            cleanup_temp_files(temp_files)
-            logger.error(f"Gotenberg API错误: {err}")
-            raise HTTPException(status_code=500, detail="文档转换失败")
-
-    except HTTPException:
-        raise
+        upstream_request = client.build_request(
+            "POST",
+            gotenberg_url,
+            files={'file': (file.filename, file.file, content_type)},
+            data=convert_options,
+            # 响应体原样转发给客户端，不能让上游按共享客户端默认的 gzip/deflate 压缩
+            headers={'Accept-Encoding': 'identity'},
+        )
+        response = await client.send(upstream_request, stream=True)
     except Exception as e:
         logger.error(f"转换过程中发生错误: {e}")
-        cleanup_temp_files(temp_files)
         raise HTTPException(status_code=500, detail=f"转换失败: {str(e)}")
 
-
-def _async_convert_task(task_id: str, base_url: str, input_path: str, output_path: str, convert_options: Dict[str, str]):
+    if response.status_code != 200:
+        await response.aread()
+        await response.aclose()
+        logger.error(f"Gotenberg API错误: HTTP {response.status_code}: {response.text}")
+        raise HTTPException(status_code=500, detail="文档转换失败")
+
+    filename = f"converted_{stem}.pdf"
+    headers = {'Content-Disposition': _content_disposition(filename)}
+    # 原样转发上游字节（不解码），长度/编码头随之透传
+    for name in ('Content-Length', 'Content-Encoding'):
+        if name in response.headers:
+            headers[name] = response.headers[name]
+    return StreamingResponse(
+        response.aiter_raw(),
+        media_type='application/pdf',
+        headers=headers,
+        background=BackgroundTask(response.aclose),
+    )
+
+
+async def _async_convert_task(client: httpx.AsyncClient, task_id: str, base_url: str, input_path: str, output_path: str, convert_options: Dict[str, str]):
     try:
         gotenberg_url = f"{base_url.rstrip('/')}/forms/libreoffice/convert"
-        success, err = _post_to_gotenberg_and_save(gotenberg_url, Path(input_path), Path(output_path), convert_options)
+        async with _get_convert_slots():
+            success, err = await _post_to_gotenberg_and_save(client, gotenberg_url, Path(input_path), Path(output_path), convert_options)
         with _task_lock:
             if success:
                 _task_status[task_id]['status'] = 'done'
@@ -146,15 +193,18 @@ def _async_convert_task(task_id: str, base_url: str, input_path: str, output_pat
             else:
                 _task_status[task_id]['status'] = 'error'
                 _task_status[task_id]['error'] = err
+            _task_status[task_id]['finished_at'] = time.time()
     except Exception as e:
         logger.error(f"异步任务异常: {e}")
         with _task_lock:
             _task_status[task_id]['status'] = 'error'
             _task_status[task_id]['error'] = str(e)
+            _task_status[task_id]['finished_at'] = time.time()
 
 
 @router.post("/converter_to_pdf_async")
 async def convert_document_async(
+    request: Request,
     background_tasks: BackgroundTasks,
     base_url: str = Form(..., description="Gotenberg服务地址"),
     file: UploadFile = File(..., description="要转换的文档文件"),
@@ -182,8 +232,7 @@ async def convert_document_async(
     output_path = OUTPUT_DIR / f"{task_id}.pdf"
 
     try:
-        with open(input_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        await _save_upload(file, input_path)
 
         convert_options = {
             'marginTop': marginTop,
@@ -198,18 +247,20 @@ async def convert_document_async(
             convert_options['pageRanges'] = pageRanges
 
         with _task_lock:
-            _task_status[task_id] = {'status': 'pending', 'output_path': None, 'error': None}
+            _task_status[task_id] = {'status': 'pending', 'input_path': str(input_path), 'output_path': None, 'error': None}
+            evicted = trim_tasks(_task_status, _MAX_TASKS)
+        if evicted:
+            # 被挤出任务的临时文件在响应后于线程池中清理，不占用事件循环
+            background_tasks.add_task(_cleanup_evicted_tasks, evicted)
 
-        # 使用后台线程立即开始异步任务（也可以使用 background_tasks.add_task，这里用线程以便尽快启动）
-        thread = threading.Thread(target=_async_convert_task, args=(task_id, base_url, str(input_path), str(output_path), convert_options), daemon=True)
-        thread.start()
+        # 响应返回后在事件循环上执行转换，复用应用级共享连接池
+        background_tasks.add_task(_async_convert_task, request.app.state.http, task_id, base_url, str(input_path), str(output_path), convert_options)
 
-        return JSONResponse({"task_id": task_id})
+        return ORJSONResponse({"task_id": task_id})
 
     except Exception as e:
         logger.error(f"异步转换提交失败: {e}")
-        if os.path.exists(input_path):
-            os.remove(input_path)
+        input_path.unlink(missing_ok=True)
         raise HTTPException(status_code=500, detail=f"异步转换提交失败: {str(e)}")
 
 
@@ -223,9 +274,9 @@ async def get_conversion_result(task_id: str, background_tasks: BackgroundTasks)
         error = _task_status[task_id].get('error')
 
     if status == 'pending':
-        return JSONResponse({"status": "pending"})
+        return ORJSONResponse({"status": "pending"})
     elif status == 'error':
-        return JSONResponse({"status": "error", "error": error}, status_code=500)
+        return ORJSONResponse({"status": "error", "error": error}, status_code=500)
     elif status == 'done' and output_path and os.path.exists(output_path):
         # 在响应后清理相关 temp 文件
         input_glob = str(UPLOAD_DIR / f"{task_id}_*")
@@ -234,6 +285,6 @@ async def get_conversion_result(task_id: str, background_tasks: BackgroundTasks)
         background_tasks.add_task(cleanup_temp_files, temp_files)
         return FileResponse(path=output_path, media_type='application/pdf', filename=f"converted_{task_id}.pdf")
     else:
-        return JSONResponse({"status": "unknown"}, status_code=500)
+        return ORJSONResponse({"status": "unknown"}, status_code=500)
 
 
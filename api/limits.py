@@ -0,0 +1,41 @@
+import logging
+
+from fastapi import HTTPException, Request
+from fastapi.routing import APIRoute
+
+from config import MAX_UPLOAD_SIZE_BYTES
+
+logger = logging.getLogger(__name__)
+
+# Content-Length 是整个 multipart 请求体的大小，包含边界、part 头和其他表单字段，
+# 在文件大小限制之外留出固定余量，避免刚好达到上限的文件被误拒
+_MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+
+def check_content_length(request: Request):
+    """
+    根据 Content-Length 头提前拒绝超限上传。
+    Content-Length 超过 MAX_UPLOAD_SIZE_BYTES + _MULTIPART_OVERHEAD_BYTES 才拒绝，文件本身的精确大小由各端点在写入时逐块校验；
+    分块传输（无 Content-Length）的请求同样由端点校验。
+    """
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > MAX_UPLOAD_SIZE_BYTES + _MULTIPART_OVERHEAD_BYTES:
+        logger.warning(f"拒绝超限上传: {request.url.path} (content-length={content_length})")
+        raise HTTPException(status_code=413, detail=f"文件大小超过限制: {MAX_UPLOAD_SIZE_BYTES} bytes")
+
+
+class UploadLimitRoute(APIRoute):
+    """
+    在读取请求体之前执行 check_content_length。
+    FastAPI 会在调用端点函数前解析完整个表单，端点内的检查无法避免接收超大请求体，
+    因此需要在路由处理器层面拦截。
+    """
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def limited_handler(request: Request):
+            check_content_length(request)
+            return await handler(request)
+
+        return limited_handler
@@ -1,22 +1,28 @@
+import asyncio
 import os
 import uuid
 import threading
 import time
 import shutil
 from pathlib import Path
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Set
 import logging
-import requests
+from collections import OrderedDict
 
-from fastapi import APIRouter, File, UploadFile, HTTPException, BackgroundTasks, Form
-from fastapi.responses import JSONResponse
+import httpx
+import orjson
+from fastapi import APIRouter, File, UploadFile, HTTPException, BackgroundTasks, Form, Request
 from pydantic import BaseModel
 
 from config import KK_HOST_PUBLIC, MAX_UPLOAD_SIZE_BYTES, MINERU_DEFAULT_BASE_URL, MINERU_TIMEOUT_SECONDS, MINERU_WORKER_THREADS, MINERU_PARSE_PATH
+from api.limits import UploadLimitRoute
+from api.responses import ORJSONResponse
+from utils.files import advise_sequential, cleanup_temp_files, drop_page_cache
+from utils.tasks import EvictedTasks, start_task_sweeper, trim_tasks
 
 logger = logging.getLogger(__name__)
 
-router = APIRouter(prefix="/mineru", tags=["mineru"])
+router = APIRouter(prefix="/mineru", tags=["mineru"], route_class=UploadLimitRoute)
 
 # temp dirs
 UPLOAD_DIR = Path("temp/mineru/uploads")
@@ -24,9 +30,14 @@ UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 
 # simple in-memory task store and queue (Mode2: hosted async)
 _task_lock = threading.Lock()
-_task_status: Dict[str, Dict[str, Any]] = {}
-_task_queue = []
-_queue_cv = threading.Condition()
+_task_status: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+# finished tasks (and their staged uploads) are dropped after an hour or once the table is full
+_MAX_TASKS = 10000
+_TASK_RETENTION_SECONDS = 3600
+# bounded queue gives backpressure (429) instead of unbounded growth; created in start_workers
+_task_queue: Optional[asyncio.Queue] = None
+_dispatcher: Optional[asyncio.Task] = None
+_inflight: Set[asyncio.Task] = set()
 
 # config defaults (can be later moved to config.py)
 MINERU_TIMEOUT_SECONDS = MINERU_TIMEOUT_SECONDS
@@ -34,6 +45,13 @@ MINERU_WORKER_THREADS = MINERU_WORKER_THREADS
 MINERU_PARSE_PATH = MINERU_PARSE_PATH
 
 
+def _cleanup_evicted_tasks(evicted: EvictedTasks):
+    cleanup_temp_files([task["file_path"] for _, task in evicted])
+
+
+start_task_sweeper("mineru-task-sweeper", _task_status, _task_lock, _TASK_RETENTION_SECONDS, _cleanup_evicted_tasks)
+
+
 def _save_upload(file: UploadFile) -> Path:
     ext = Path(file.filename or "").suffix
     fid = str(uuid.uuid4())
@@ -59,50 +77,52 @@ def _normalize_mineru_response(data: Any) -> Any:
     If Mineru response contains 'results' as a single-item mapping whose value
     contains 'md_content', set 'md_result' to that md_content string and remove 'results'.
     """
-    try:
-        if isinstance(data, dict) and "results" in data:
-            results = data.get("results")
-            # Case: results is a mapping with a single entry containing md_content
-            if isinstance(results, dict) and len(results) == 1:
-                first_val = next(iter(results.values()))
-                if isinstance(first_val, dict) and "md_content" in first_val:
-                    data["md_result"] = first_val["md_content"]
-                    try:
-                        del data["results"]
-                    except Exception:
-                        pass
-            # Case: results already normalized as a string -> move to md_result
-            elif isinstance(results, str):
-                data["md_result"] = results
-                try:
-                    del data["results"]
-                except Exception:
-                    pass
-    except Exception:
-        # On any error, return original data unchanged
+    if not isinstance(data, dict):
+        return data
+    results = data.get("results")
+    if results is None:
         return data
+    # Case: results is a mapping with a single entry containing md_content
+    if isinstance(results, dict) and len(results) == 1:
+        first_val = next(iter(results.values()))
+        if isinstance(first_val, dict) and "md_content" in first_val:
+            data["md_result"] = first_val["md_content"]
+            data.pop("results", None)
+    # Case: results already normalized as a string -> move to md_result
+    elif isinstance(results, str):
+        data["md_result"] = results
+        data.pop("results", None)
     return data
 
 
-def _call_mineru_parse(base_url: str, file_path: Optional[Path] = None, target_url: Optional[str] = None, timeout: int = MINERU_TIMEOUT_SECONDS):
+async def _call_mineru_parse(client: httpx.AsyncClient, base_url: str, file_path: Optional[Path] = None, target_url: Optional[str] = None, timeout: int = MINERU_TIMEOUT_SECONDS, upload: Optional[UploadFile] = None):
     """
-    Call Mineru parse endpoint. Only file_path (multipart upload) is supported.
+    Call Mineru parse endpoint. Only multipart upload is supported, either from a staged
+    file_path or directly from the request's spooled upload.
     URL-based parsing has been disabled intentionally.
     """
     if not base_url:
         raise RuntimeError("mineru base_url required")
-    if not file_path:
+    if not file_path and upload is None:
         raise RuntimeError("URL-based parsing disabled; use file upload")
     url = f"{base_url.rstrip('/')}{MINERU_PARSE_PATH}"
     try:
         # Mineru OpenAPI expects multipart form field name "files" (array).
-        with open(file_path, "rb") as f:
-            files = [("files", (file_path.name, f, "application/octet-stream"))]
-            resp = requests.post(url, files=files, timeout=timeout)
+        if upload is not None:
+            name = f"{uuid.uuid4()}{Path(upload.filename or '').suffix}"
+            files = [("files", (name, upload.file, "application/octet-stream"))]
+            resp = await client.post(url, files=files, timeout=timeout)
+        else:
+            with open(file_path, "rb") as f:
+                advise_sequential(f.fileno())
+                files = [("files", (file_path.name, f, "application/octet-stream"))]
+                resp = await client.post(url, files=files, timeout=timeout)
+                # uploaded copy is not read again; release its page cache
+                await asyncio.to_thread(drop_page_cache, f.fileno())
         resp.raise_for_status()
         # Try to return JSON, if response is not JSON, return text wrapped
         try:
-            data = resp.json()
+            data = orjson.loads(resp.content)
         except ValueError:
             data = {"text": resp.text}
         return _normalize_mineru_response(data)
@@ -111,52 +131,77 @@ def _call_mineru_parse(base_url: str, file_path: Optional[Path] = None, target_u
         raise
 
 
-def _worker_loop():
+async def _dispatch_loop(client: httpx.AsyncClient):
+    """
+    Single dispatcher: pull task ids off the queue and run up to MINERU_WORKER_THREADS
+    Mineru calls concurrently on the shared client.
+    """
+    semaphore = asyncio.Semaphore(MINERU_WORKER_THREADS)
     while True:
-        with _queue_cv:
-            while not _task_queue:
-                _queue_cv.wait()
-            task_id = _task_queue.pop(0)
-        # process task
-        with _task_lock:
-            task = _task_status.get(task_id)
-            if not task or task.get("status") != "pending":
-                continue
-            task["status"] = "processing"
-            task["started_at"] = time.time()
-        try:
-            base_url = task.get("base_url")
-            file_path = task.get("file_path")
-            result = None
-            if file_path:
-                result = _call_mineru_parse(base_url, file_path=Path(file_path))
-            else:
-                # URL-based tasks removed; mark task as error
-                task["status"] = "error"
-                task["error"] = "no file_path in task; URL-based parsing removed"
-                task["finished_at"] = time.time()
-                continue
-            with _task_lock:
-                task["status"] = "done"
-                task["result"] = result
-                task["finished_at"] = time.time()
-        except Exception as e:
+        task_id = await _task_queue.get()
+        await semaphore.acquire()
+        job = asyncio.create_task(_run_task(client, task_id, semaphore))
+        _inflight.add(job)
+        job.add_done_callback(_inflight.discard)
+
+
+async def _run_task(client: httpx.AsyncClient, task_id: str, semaphore: asyncio.Semaphore):
+    try:
+        await _process_task(client, task_id)
+    finally:
+        semaphore.release()
+        _task_queue.task_done()
+
+
+async def _process_task(client: httpx.AsyncClient, task_id: str):
+    with _task_lock:
+        task = _task_status.get(task_id)
+        if not task or task.get("status") != "pending":
+            return
+        task["status"] = "processing"
+        task["started_at"] = time.time()
+    try:
+        base_url = task.get("base_url")
+        file_path = task.get("file_path")
+        if not file_path:
+            # URL-based tasks removed; mark task as error
             with _task_lock:
                 task["status"] = "error"
-                task["error"] = str(e)
+                task["error"] = "no file_path in task; URL-based parsing removed"
                 task["finished_at"] = time.time()
+            return
+        result = await _call_mineru_parse(client, base_url, file_path=Path(file_path))
+        with _task_lock:
+            task["status"] = "done"
+            task["result"] = result
+            task["finished_at"] = time.time()
+    except Exception as e:
+        with _task_lock:
+            task["status"] = "error"
+            task["error"] = str(e)
+            task["finished_at"] = time.time()
 
 
-# start worker threads
-for i in range(MINERU_WORKER_THREADS):
-    t = threading.Thread(target=_worker_loop, daemon=True, name=f"mineru-worker-{i}")
-    t.start()
+def start_workers(client: httpx.AsyncClient):
+    """
+    Start the Mineru dispatcher on the running event loop (called on app startup).
+    """
+    global _task_queue, _dispatcher
+    _task_queue = asyncio.Queue(maxsize=MINERU_WORKER_THREADS * 4)
+    _dispatcher = asyncio.create_task(_dispatch_loop(client), name="mineru-dispatcher")
 
 
+async def stop_workers():
+    pending = list(_inflight)
+    if _dispatcher is not None:
+        pending.append(_dispatcher)
+    for t in pending:
+        t.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
 
 
 @router.post("/parse/file")
-async def parse_file(file: UploadFile = File(...), base_url: Optional[str] = Form(None)):
+async def parse_file(request: Request, file: UploadFile = File(...), base_url: Optional[str] = Form(None)):
     """
     Synchronous parse for an uploaded file. Provide optional form field base_url to override default.
     """
@@ -171,13 +216,16 @@ async def parse_file(file: UploadFile = File(...), base_url: Optional[str] = For
     if not is_pdf:
         raise HTTPException(status_code=415, detail="Only PDF files are supported for Mineru parsing")
 
-    saved = _save_upload(file)
+    # chunked uploads carry no Content-Length; the parsed size is the fallback check
+    if file.size is not None and file.size > MAX_UPLOAD_SIZE_BYTES:
+        raise HTTPException(status_code=413, detail="file too large")
     use_base = base_url or MINERU_DEFAULT_BASE_URL
     if not use_base:
         raise HTTPException(status_code=400, detail="MINERU_DEFAULT_BASE_URL not configured")
     try:
-        res = _call_mineru_parse(use_base, file_path=saved)
-        return JSONResponse(res)
+        # stream the already-spooled upload to Mineru instead of staging another copy on disk
+        res = await _call_mineru_parse(request.app.state.http, use_base, upload=file)
+        return ORJSONResponse(res)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -186,7 +234,7 @@ async def parse_file(file: UploadFile = File(...), base_url: Optional[str] = For
 
 
 @router.post("/parse_async/file")
-async def parse_async_file(file: UploadFile = File(...), base_url: Optional[str] = Form(None)):
+async def parse_async_file(background_tasks: BackgroundTasks, file: UploadFile = File(...), base_url: Optional[str] = Form(None)):
     """
     Submit async parse job for uploaded file. Returns { task_id }.
     """
@@ -201,17 +249,23 @@ async def parse_async_file(file: UploadFile = File(...), base_url: Optional[str]
     if not is_pdf:
         raise HTTPException(status_code=415, detail="Only PDF files are supported for Mineru parsing")
 
-    saved = _save_upload(file)
     use_base = base_url or MINERU_DEFAULT_BASE_URL
     if not use_base:
         raise HTTPException(status_code=400, detail="MINERU_DEFAULT_BASE_URL not configured")
+    # reject before staging the upload; nothing below awaits, so the slot is still free at put_nowait
+    if _task_queue.full():
+        raise HTTPException(status_code=429, detail="too many pending parse tasks, retry later")
+    saved = _save_upload(file)
     task_id = str(uuid.uuid4())
+    # no await between enqueue and registering the task, so workers always see the record
+    _task_queue.put_nowait(task_id)
     with _task_lock:
         _task_status[task_id] = {"status": "pending", "base_url": use_base, "file_path": str(saved), "created_at": time.time()}
-    with _queue_cv:
-        _task_queue.append(task_id)
-        _queue_cv.notify()
-    return JSONResponse({"task_id": task_id})
+        evicted = trim_tasks(_task_status, _MAX_TASKS)
+    if evicted:
+        # staged uploads of evicted tasks are removed after the response, off the event loop
+        background_tasks.add_task(_cleanup_evicted_tasks, evicted)
+    return ORJSONResponse({"task_id": task_id})
 
 
 @router.get("/parse_result/{task_id}")
@@ -220,6 +274,6 @@ async def parse_result(task_id: str):
         task = _task_status.get(task_id)
         if not task:
             raise HTTPException(status_code=404, detail="unknown task_id")
-        return JSONResponse(task)
+        return ORJSONResponse(task)
 
 
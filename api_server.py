@@ -15,7 +15,9 @@ from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks, F
 from fastapi.responses import FileResponse
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
-import requests
+import httpx
+
+from api.responses import ORJSONResponse
 
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -26,6 +28,7 @@ app = FastAPI(
     title="文档转换API",
     description="基于Gotenberg的Office文档转换为PDF的API服务",
     version="1.0.0",
+    default_response_class=ORJSONResponse,
 )
 
 # 配置CORS
@@ -36,6 +39,24 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+
+
+@app.on_event("startup")
+async def on_startup():
+    # 应用级共享 HTTP 连接池，复用到 Gotenberg / Mineru 的 TCP(+TLS) 连接
+    app.state.http = httpx.AsyncClient(
+        timeout=300,
+        limits=httpx.Limits(max_keepalive_connections=64, max_connections=256),
+    )
+    mineru_api.start_workers(app.state.http)
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await mineru_api.stop_workers()
+    await app.state.http.aclose()
+
+
 from api.libreoffice import api as libreoffice_api
 from api.kkfileview import api as kkfileview_api
 from api.mineru import api as mineru_api
@@ -1,41 +1,110 @@
+"""
+Service settings, read from env / .env / env.example with environment variables as fallback.
+
+Cheap to import: the env file is only read when a setting is first accessed
+(PEP 562 module __getattr__), after which the value is cached as a module global.
+"""
+import functools
+import marshal
 import os
-from pathlib import Path
+import re
 from typing import Dict, Optional
 
 
+# One `KEY=value` per line, same rules as the old line-by-line parser: comment lines (`#`)
+# and lines without `=` are skipped, key/value are trimmed of ASCII whitespace and surrounding
+# quote characters are dropped from the value. Matches raw bytes with line endings normalised
+# to `\n`; only key/value get decoded.
+_ENV_WS = rb"[ \t\r\f\v\x1c-\x1f]"
+_ENV_LINE_RE = re.compile(
+    rb"^" + _ENV_WS + rb"*([^#=\s\x1c-\x1f][^=\n]*?)?" + _ENV_WS + rb"*=" + _ENV_WS + rb"""*['"]*(.*?)['"]*""" + _ENV_WS + rb"*$",
+    re.MULTILINE,
+)
+
+
+_MAX_ENV_FILE_BYTES = 1 << 20
+
+# Bump whenever the parsing rules change so caches written by older code are ignored
+_ENV_CACHE_VERSION = 2
+
+
+def _read_env_cache(cache_path: str, mtime_ns: int, size: int) -> Optional[Dict[str, str]]:
+    """Return the cached parse of an env file if it matches the parser version, mtime and size."""
+    try:
+        with open(cache_path, "rb") as f:
+            key, env = marshal.loads(f.read())
+    except Exception:
+        return None
+    if key != (_ENV_CACHE_VERSION, mtime_ns, size) or not isinstance(env, dict):
+        return None
+    return env
+
+
+def _write_env_cache(cache_path: str, mtime_ns: int, size: int, env: Dict[str, str]):
+    # best-effort: write to a temp file and atomically swap it in
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(marshal.dumps(((_ENV_CACHE_VERSION, mtime_ns, size), env)))
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
 def _load_env_file(paths=("env", ".env", "env.example")) -> Dict[str, str]:
     env: Dict[str, str] = {}
     for p in paths:
-        path = Path(p)
-        if not path.exists():
+        if not os.path.isfile(p):
             continue
         try:
-            with path.open("r", encoding="utf-8") as f:
-                for line in f:
-                    s = line.strip()
-                    if not s or s.startswith("#"):
-                        continue
-                    if "=" not in s:
-                        continue
-                    k, v = s.split("=", 1)
-                    k = k.strip()
-                    v = v.strip().strip('\'"')
-                    env[k] = v
+            with open(p, "rb") as f:
+                st = os.fstat(f.fileno())
+                # bound the work: anything this large is not an env file, try the next candidate
+                if st.st_size > _MAX_ENV_FILE_BYTES:
+                    continue
+                if st.st_size == 0:
+                    return {}
+                # parsed result is cached next to the env file, keyed by parser version, mtime and size
+                cache_path = p + ".cache"
+                mtime_ns, size = st.st_mtime_ns, st.st_size
+                cached = _read_env_cache(cache_path, mtime_ns, size)
+                if cached is not None:
+                    return cached
+                data = f.read(_MAX_ENV_FILE_BYTES + 1)
+            if len(data) > _MAX_ENV_FILE_BYTES:
+                continue
+            # universal newlines, like the old text-mode reader: \r\n and bare \r end a line too
+            data = data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+            for m in _ENV_LINE_RE.finditer(data):
+                env[(m.group(1) or b"").decode("utf-8")] = m.group(2).decode("utf-8")
+            _write_env_cache(cache_path, mtime_ns, size, env)
             return env
         except Exception:
             continue
     return env
 
 
-_ENV = _load_env_file()
+_ENV: Optional[Dict[str, str]] = None
 
 
+def _env() -> Dict[str, str]:
+    global _ENV
+    if _ENV is None:
+        _ENV = _load_env_file()
+    return _ENV
+
+
+@functools.lru_cache(maxsize=None)
 def _get_str(key: str, default: Optional[str] = None) -> Optional[str]:
-    return _ENV.get(key, os.environ.get(key, default))
+    return _env().get(key, os.environ.get(key, default))
 
 
+@functools.lru_cache(maxsize=None)
 def _get_int(key: str, default: int = 0) -> int:
-    val = _ENV.get(key, os.environ.get(key))
+    val = _env().get(key, os.environ.get(key))
     if val is None:
         return default
     try:
@@ -44,19 +113,41 @@ def _get_int(key: str, default: int = 0) -> int:
         return default
 
 
-# Public settings
-KK_HOST_PUBLIC: str = _get_str("KK_HOST_PUBLIC", "localhost:8000")
-MAX_UPLOAD_SIZE_BYTES: int = _get_int("MAX_UPLOAD_SIZE_BYTES", 100 * 1024 * 1024)
-# TEMP_RETENTION_SECONDS removed: uploaded files are kept permanently by default
-# Mineru defaults
-MINERU_DEFAULT_BASE_URL: str = _get_str("MINERU_DEFAULT_BASE_URL", "")
-MINERU_TIMEOUT_SECONDS: int = _get_int("MINERU_TIMEOUT_SECONDS", 120)
-MINERU_WORKER_THREADS: int = _get_int("MINERU_WORKER_THREADS", 2)
-MINERU_PARSE_PATH: str = _get_str("MINERU_PARSE_PATH", "/file_parse")
-
-# Ensure base temp directory exists so modules can create subdirs safely
-try:
-    Path("temp").mkdir(parents=True, exist_ok=True)
-except Exception:
-    # best-effort; if creation fails, modules will still raise meaningful errors
-    pass
+# Public settings, resolved on first access by __getattr__ and then bound as module globals
+_SETTINGS = {
+    "KK_HOST_PUBLIC": lambda: _get_str("KK_HOST_PUBLIC", "localhost:8000"),
+    "MAX_UPLOAD_SIZE_BYTES": lambda: _get_int("MAX_UPLOAD_SIZE_BYTES", 100 * 1024 * 1024),
+    # TEMP_RETENTION_SECONDS removed: uploaded files are kept permanently by default
+    # kkfileview uploads not accessed for this many seconds are swept; 0 keeps them permanently
+    "KK_TEMP_TTL_SECONDS": lambda: _get_int("KK_TEMP_TTL_SECONDS", 0),
+    # Mineru defaults
+    "MINERU_DEFAULT_BASE_URL": lambda: _get_str("MINERU_DEFAULT_BASE_URL", ""),
+    "MINERU_TIMEOUT_SECONDS": lambda: _get_int("MINERU_TIMEOUT_SECONDS", 120),
+    "MINERU_WORKER_THREADS": lambda: _get_int("MINERU_WORKER_THREADS", 2),
+    "MINERU_PARSE_PATH": lambda: _get_str("MINERU_PARSE_PATH", "/file_parse"),
+    # LibreOffice (Gotenberg) async conversions allowed to run at once
+    "LIBRE_WORKER_THREADS": lambda: _get_int("LIBRE_WORKER_THREADS", 4),
+}
+
+KK_HOST_PUBLIC: str
+MAX_UPLOAD_SIZE_BYTES: int
+KK_TEMP_TTL_SECONDS: int
+MINERU_DEFAULT_BASE_URL: str
+MINERU_TIMEOUT_SECONDS: int
+MINERU_WORKER_THREADS: int
+MINERU_PARSE_PATH: str
+LIBRE_WORKER_THREADS: int
+
+
+def __getattr__(name: str):
+    try:
+        resolve = _SETTINGS[name]
+    except KeyError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}") from None
+    value = resolve()
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_SETTINGS))
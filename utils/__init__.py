@@ -0,0 +1,2 @@
+# utils package
+
@@ -0,0 +1,40 @@
+import logging
+import os
+from pathlib import Path
+from typing import List
+
+logger = logging.getLogger(__name__)
+
+
+def cleanup_temp_files(file_paths: List[str]):
+    """清理临时文件（文件已被其他清理者删除时静默跳过）"""
+    for file_path in file_paths:
+        try:
+            Path(file_path).unlink()
+            logger.info(f"已清理临时文件: {file_path}")
+        except FileNotFoundError:
+            continue
+        except OSError as e:
+            logger.error(f"清理临时文件失败: {file_path}, 错误: {e}")
+
+
+def advise_sequential(fd: int):
+    """提示内核该文件将被顺序读取一次，加大预读（不支持 posix_fadvise 的平台上无操作）"""
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass
+
+
+def drop_page_cache(fd: int):
+    """
+    提示内核不再需要该文件的页缓存，避免一次性大文件挤占热点数据。
+    POSIX_FADV_DONTNEED 不会丢弃脏页，因此先 fdatasync 落盘；该调用会阻塞，异步代码中应放到线程里执行。
+    """
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.fdatasync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        except OSError:
+            pass
@@ -0,0 +1,57 @@
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, MutableMapping, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 任务表：task_id -> 任务信息，按创建顺序排列；已结束的任务带有 finished_at
+TaskTable = MutableMapping[str, Dict[str, Any]]
+EvictedTasks = List[Tuple[str, Dict[str, Any]]]
+
+
+def trim_tasks(tasks: TaskTable, max_tasks: int) -> EvictedTasks:
+    """
+    任务数超过 max_tasks 时，从最早创建的开始移除已结束的任务，返回被移除的任务。
+    未结束的任务不会被移除（调用方需持有任务锁，并在释放锁后再清理被移除任务的文件）。
+    """
+    excess = len(tasks) - max_tasks
+    if excess <= 0:
+        return []
+    evicted = []
+    for task_id, task in tasks.items():
+        if "finished_at" in task:
+            evicted.append(task_id)
+            if len(evicted) >= excess:
+                break
+    return [(task_id, tasks.pop(task_id)) for task_id in evicted]
+
+
+def expire_tasks(tasks: TaskTable, retention_seconds: float, now: float) -> EvictedTasks:
+    """移除结束时间早于 now - retention_seconds 的任务并返回（调用方需持有任务锁）"""
+    expired = [
+        task_id for task_id, task in tasks.items()
+        if now - task.get("finished_at", now) > retention_seconds
+    ]
+    return [(task_id, tasks.pop(task_id)) for task_id in expired]
+
+
+def start_task_sweeper(name: str, tasks: TaskTable, lock: threading.Lock, retention_seconds: float,
+                       on_evict: Callable[[EvictedTasks], None], interval: float = 60):
+    """
+    启动后台线程，每 interval 秒清理一次过期任务。
+    仅在持锁期间摘除记录，on_evict（文件清理等磁盘 I/O）在释放锁后执行，不阻塞请求处理。
+    """
+
+    def _loop():
+        while True:
+            time.sleep(interval)
+            try:
+                with lock:
+                    evicted = expire_tasks(tasks, retention_seconds, time.time())
+                if evicted:
+                    on_evict(evicted)
+            except Exception as e:
+                logger.error(f"任务清理失败({name}): {e}")
+
+    threading.Thread(target=_loop, daemon=True, name=name).start()